@@ -1,166 +1,427 @@
 # ruka_trends_mvp.py
 # Google Trends → weekly + KPIs + recommendations → Google Sheets
 
-import argparse, json, os, sys, time
+import argparse, hashlib, json, math, os, random, re, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
 try:
+    import requests
+    import pytrends.request as _pytrends_request
     from pytrends.request import TrendReq
 except Exception:
     TrendReq = None
 
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except Exception:
+    pa = pacsv = None
+
+DAY_NS = 86_400_000_000_000
+CATEGORY_COLUMNS = ("market","language","intent","term")
+KP_COLUMNS = ["avg_monthly_searches","cpc_eur","competition_index"]
+WEEKLY_COLUMNS = ["week_start","market","language","term","intent","source",
+                  "trend_index_0_100"] + KP_COLUMNS
+
 
-def _maybe_sheet_update(df: pd.DataFrame, worksheet: str):
+def _maybe_sheet_update(df: pd.DataFrame, worksheet: str, sheet_id: str = None):
     sa_json = os.environ.get("GOOGLE_SA_JSON")
     sheet_name = os.environ.get("SHEET_NAME")
-    sheet_id = os.environ.get("SHEET_ID")
+    sheet_id = sheet_id or os.environ.get("SHEET_ID")
     if not sa_json or not (sheet_name or sheet_id):
         print(f"No GOOGLE_SA_JSON or (SHEET_NAME/SHEET_ID) → skip '{worksheet}'")
         return
     try:
         from update_sheet import df_to_sheet
-        df_to_sheet(df, sheet_name or "", worksheet)
+        df_to_sheet(df, sheet_name or "", worksheet, sheet_id=sheet_id)
         print(f"✅ Sheet updated: {(sheet_name or sheet_id)} / {worksheet} (rows={len(df)})")
     except Exception as e:
         print(f"[WARN] Failed to update '{worksheet}': {e}", file=sys.stderr)
 
 
+def write_frame(df: pd.DataFrame, out: str):
+    if out.endswith(".parquet"):
+        df.to_parquet(out, index=False, compression="zstd")
+        return
+    if pacsv is not None:
+        # Arrow kirjoittaa sarakkeet C++:ssa; keskiyön aikaleimat päivinä kuten pandasin CSV
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            for i, field in enumerate(table.schema):
+                if pa.types.is_timestamp(field.type) and \
+                        not (df[field.name].to_numpy(dtype="datetime64[ns]").view("int64") % DAY_NS).any():
+                    table = table.set_column(i, field.name, table.column(i).cast(pa.date32()))
+            if out.endswith(".gz"):
+                with pa.CompressedOutputStream(out, "gzip") as sink:
+                    pacsv.write_csv(table, sink)
+            else:
+                pacsv.write_csv(table, out)
+            return
+        except pa.ArrowException as e:
+            print(f"[WARN] pyarrow CSV write failed, falling back to pandas: {e}", file=sys.stderr)
+    df.to_csv(out, index=False)  # pakkaus päätellään päätteestä (.gz)
+
+
 def load_terms(json_path: Path) -> pd.DataFrame:
-    data = json.loads(json_path.read_text(encoding="utf-8"))
-    return pd.DataFrame(data["terms"])  # columns: market, language, intent, term
+    # Tavut suoraan parserille: ei erillistä str-dekoodausta (orjson, jos asennettu)
+    raw = json_path.read_bytes()
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    df = pd.DataFrame(data["terms"])  # columns: market, language, intent, term
+    # Toistuvat merkkijonot kategorioiksi → groupby/merge int-koodeilla
+    for c in CATEGORY_COLUMNS:
+        df[c] = df[c].astype("category")
+    return df
+
+
+class _RateLimiter:
+    """Spaces request starts at least `interval` seconds apart across all threads."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            start = max(time.monotonic(), self._next)
+            self._next = start + self.interval
+        delay = start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def defer(self, delay: float):
+        # Palvelimen pyytämä tauko koskee koko asiakasta → siirretään kaikkien säikeiden seuraavaa aloitusta
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + delay)
+
+
+_local = threading.local()
+
+
+def _pooled_session():
+    # Yksi keep-alive-sessio per worker-säie → TCP+TLS-kättely kerran, ei joka pyynnöllä
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
+
+
+class _PooledRequests:
+    """Stands in for `requests` inside pytrends, which otherwise opens a new Session per call."""
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def session(self):
+        return _pooled_session()
+
+    def get(self, *args, **kwargs):
+        return _pooled_session().get(*args, **kwargs)
+
+
+if TrendReq is not None:
+    _pytrends_request.requests = _PooledRequests()
 
 
-def fetch_trends(df_terms: pd.DataFrame, tz: int = 180) -> pd.DataFrame:
+def _thread_pytrends(tz: int):
+    # pytrends ei ole säieturvallinen → yksi TrendReq per worker-säie
+    pytrends = getattr(_local, "pytrends", None)
+    if pytrends is None:
+        pytrends = _local.pytrends = TrendReq(hl="en-US", tz=tz)
+    return pytrends
+
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 30
+
+
+def _retry_delay(response, failures: int, limiter: _RateLimiter) -> float:
+    # Palvelimen Retry-After (sekunteina, enintään MAX_BACKOFF) voittaa ja jaetaan limiterille;
+    # muuten full jitter: U(0, min(30, 2^n))
+    retry_after = (getattr(response, "headers", None) or {}).get("Retry-After", "")
+    if retry_after.strip().isdigit():
+        delay = min(float(retry_after), MAX_BACKOFF)
+        limiter.defer(delay)
+        return delay
+    return random.uniform(0, min(MAX_BACKOFF, 2 ** failures))
+
+
+def _interest_over_time(pytrends, kw_batch: list, geo: str, timeframe: str,
+                        limiter: _RateLimiter) -> pd.DataFrame:
+    # Ei kiinteää odotusta onnistumisen jälkeen; 429/5xx → eksponentiaalinen backoff
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        limiter.wait()
+        try:
+            pytrends.build_payload(kw_batch, cat=0, timeframe=timeframe, geo=geo, gprop="")
+            df = pytrends.interest_over_time()
+        except Exception as e:
+            response = getattr(e, "response", None)
+            status = getattr(response, "status_code", None)
+            if status not in RETRY_STATUS or attempt == MAX_ATTEMPTS:
+                raise
+            _local.failures = getattr(_local, "failures", 0) + 1
+            delay = _retry_delay(response, _local.failures, limiter)
+            print(f"[WARN] HTTP {status} for {kw_batch} ({geo}); retry {attempt} in {delay:.1f}s",
+                  file=sys.stderr)
+            time.sleep(delay)
+            continue
+        _local.failures = 0
+        return df
+
+
+CACHE_DIR = Path(".cache/trends")
+
+
+def _cached_iot(kw_batch: list, geo: str, timeframe: str, tz: int,
+                limiter: _RateLimiter, ttl: float, force: bool = False) -> pd.DataFrame:
+    # Välimuisti: (geo, timeframe, tz, termit, ISO-viikko) → parquet; osuma TTL:n sisällä ohittaa verkon.
+    # Uusi viikko vaihtaa avaimen, joten edellisen viikon sarja ei jää voimaan; force ohittaa lukemisen
+    iso_year, iso_week, _ = datetime.now(timezone.utc).isocalendar()
+    key = json.dumps([geo, timeframe, tz, sorted(kw_batch), iso_year, iso_week], ensure_ascii=False)
+    path = CACHE_DIR / geo / f"{hashlib.blake2b(key.encode()).hexdigest()[:16]}.parquet"
+    if not force and ttl > 0 and path.exists() and path.stat().st_mtime > time.time() - ttl:
+        try:
+            return pd.read_parquet(path)
+        except Exception as e:
+            print(f"[WARN] Unreadable cache {path}: {e}", file=sys.stderr)
+
+    df = _interest_over_time(_thread_pytrends(tz), kw_batch, geo, timeframe, limiter)
+    if ttl > 0:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            df.to_parquet(path)
+        except Exception as e:
+            print(f"[WARN] Failed to cache {kw_batch} ({geo}): {e}", file=sys.stderr)
+    return df
+
+
+def _fetch_one(market: str, kw_batch: list, timeframe: str, tz: int,
+               limiter: _RateLimiter, cache_ttl: float, force: bool,
+               market_cats: pd.Index, term_cats: pd.Index):
+    df = _cached_iot(kw_batch, market, timeframe, tz, limiter, cache_ttl, force)
+    if df.empty:
+        return None
+    # Pitkä muoto suoraan (T, K)-matriisista ilman reset_index/melt-välivaiheita;
+    # market/term heti kategoriakoodeiksi (K hakua per erä, ei T*K merkkijonoa)
+    cols = [c for c in df.columns if c != "isPartial"]
+    mat = df[cols].to_numpy()
+    T, K = mat.shape
+    return (np.repeat(df.index.values, K),
+            np.tile(term_cats.get_indexer(cols), T),
+            mat.ravel(),
+            np.full(T * K, market_cats.get_loc(market)))
+
+
+def fetch_trends(df_terms: pd.DataFrame, tz: int = 180, cache_ttl: float = 86400,
+                 force: bool = False) -> pd.DataFrame:
     if TrendReq is None:
         raise RuntimeError("pytrends not installed. Run: pip install pytrends")
 
-    pytrends = TrendReq(hl="en-US", tz=tz)
     timeframe = "today 12-m"
-    results = []
+    # Työlista (market, ≤5 termiä) yhdellä groupby-ajolla: juokseva numero per market // 5.
+    # term objektina, koska agg(list) ei toimi kategoriasarakkeelle
+    work = (df_terms.assign(term=df_terms["term"].astype(object),
+                            _b=df_terms.groupby("market", sort=False, observed=True).cumcount() // 5)
+                    .groupby(["market","_b"], sort=False, observed=True)["term"].agg(list))
+    batches = [(market, kw_batch) for (market, _), kw_batch in work.items()]
 
-    for market, group in df_terms.groupby("market"):
-        geo = market
-        terms = group["term"].tolist()
-        for i in range(0, len(terms), 5):
-            kw_batch = terms[i : i + 5]
+    # Yhteinen rajoitin pitää kokonais-QPS:n Googlen rajan alla
+    limiter = _RateLimiter(float(os.environ.get("TRENDS_MIN_INTERVAL", "1.0")))
+    # Sarakkeittain kerättävät taulukot; DataFrame rakennetaan kerran lopussa
+    dates, terms, values, markets = [], [], [], []
+    market_dtype, term_dtype = df_terms["market"].dtype, df_terms["term"].dtype
+    with ThreadPoolExecutor(max_workers=int(os.environ.get("TRENDS_WORKERS", "8"))) as ex:
+        futures = {ex.submit(_fetch_one, m, b, timeframe, tz, limiter, cache_ttl, force,
+                             market_dtype.categories, term_dtype.categories): (m, b)
+                   for m, b in batches}
+        for fut in as_completed(futures):
+            market, kw_batch = futures[fut]
             try:
-                pytrends.build_payload(kw_batch, cat=0, timeframe=timeframe, geo=geo, gprop="")
-                df = pytrends.interest_over_time()
-                time.sleep(2)
-                if df.empty:
-                    continue
-                df = df.drop(columns=["isPartial"], errors="ignore").reset_index(names=["date"])
-                df["market"] = market
-                df_long = df.melt(
-                    id_vars=["date", "market"],
-                    var_name="term",
-                    value_name="trend_index_0_100",
-                )
-                results.append(df_long)
+                batch = fut.result()
             except Exception as e:
-                print(f"[WARN] Failed batch {kw_batch} ({geo}): {e}", file=sys.stderr)
-                time.sleep(3)
-
-    if not results:
-        return pd.DataFrame(
-            columns=["week_start","market","language","term","source",
-                     "trend_index_0_100","avg_monthly_searches","cpc_eur","competition_index"]
-        )
-
-    all_trends = pd.concat(results, ignore_index=True)
-    all_trends = all_trends.merge(
-        df_terms[["market","language","term","intent"]],
-        on=["market","term"], how="left"
-    )
-    all_trends["date"] = pd.to_datetime(all_trends["date"])
-    all_trends["week_start"] = all_trends["date"] - pd.to_timedelta(all_trends["date"].dt.weekday, unit="D")
-
-    weekly = (all_trends.groupby(["week_start","market","language","term"], as_index=False)
-              .agg(trend_index_0_100=("trend_index_0_100","mean"))
-              .sort_values(["week_start","market","term"]))
-    weekly["source"] = "GoogleTrends"
-    weekly["avg_monthly_searches"] = pd.NA
-    weekly["cpc_eur"] = pd.NA
-    weekly["competition_index"] = pd.NA
-    return weekly[["week_start","market","language","term","source",
-                   "trend_index_0_100","avg_monthly_searches","cpc_eur","competition_index"]]
+                print(f"[WARN] Failed batch {kw_batch} ({market}): {e}", file=sys.stderr)
+                continue
+            if batch is not None:
+                for acc, arr in zip((dates, terms, values, markets), batch):
+                    acc.append(arr)
+
+    if not dates:
+        return pd.DataFrame(columns=WEEKLY_COLUMNS)
+
+    # Samat kategoriat kuin df_terms:ssä, jotta koodit ovat vertailukelpoisia
+    all_trends = pd.DataFrame({
+        "date": np.concatenate(dates),
+        "market": pd.Categorical.from_codes(np.concatenate(markets), dtype=market_dtype),
+        "term": pd.Categorical.from_codes(np.concatenate(terms), dtype=term_dtype),
+        "trend_index_0_100": np.concatenate(values).astype(float),
+    })
+    # (market, term) → df_terms-rivi pienestä 2D-taulusta kategoriakoodeilla, ei hash-joinia.
+    # Taulu olettaa m:1-avaimen (vrt. merge validate="m:1"); duplikaatista vain varoitus
+    if df_terms.duplicated(["market","term"]).any():
+        print("[WARN] Duplicate (market, term) rows in terms; using the last language/intent",
+              file=sys.stderr)
+    pos = np.full((len(df_terms["market"].cat.categories), len(df_terms["term"].cat.categories)), -1)
+    pos[df_terms["market"].cat.codes.to_numpy(), df_terms["term"].cat.codes.to_numpy()] = np.arange(len(df_terms))
+    mc = all_trends["market"].cat.codes.to_numpy()
+    tc = all_trends["term"].cat.codes.to_numpy()
+    rows = np.where((mc >= 0) & (tc >= 0), pos[mc, tc], -1)
+    for c in ("language","intent"):
+        codes = df_terms[c].cat.codes.to_numpy()
+        all_trends[c] = pd.Categorical.from_codes(np.where(rows >= 0, codes[rows], -1),
+                                                  dtype=df_terms[c].dtype)
+    # Viikon maanantai suoraan int64-ns:stä (1970-01-01 oli torstai = 3);
+    # date on jo datetime64 (pytrendsin indeksi), joten erillinen to_datetime-kierros jää pois
+    ns = all_trends["date"].to_numpy(dtype="datetime64[ns]").view("int64")
+    offset = ns // DAY_NS
+    offset += 3
+    offset %= 7
+    offset *= DAY_NS
+    all_trends["week_start"] = (ns - offset).view("datetime64[ns]")
+
+    # "today 12-m" palautuu jo viikkotasolla → keskiarvoistetaan vain, jos avaimissa on duplikaatteja
+    keys = ["week_start","market","language","term"]
+    weekly = all_trends
+    if all_trends.duplicated(subset=keys).any():
+        weekly = (all_trends.groupby(keys, as_index=False, sort=False, observed=True)
+                  .agg(intent=("intent","first"),
+                       trend_index_0_100=("trend_index_0_100","mean")))
+    weekly = weekly.sort_values(["week_start","market","term"], kind="stable").reset_index(drop=True)
+    weekly["source"] = pd.Categorical.from_codes(np.zeros(len(weekly), dtype=np.int8),
+                                                 categories=["GoogleTrends"])
+    weekly[KP_COLUMNS] = pd.NA  # Keyword Planner -sarakkeet yhdellä sijoituksella
+    return weekly[WEEKLY_COLUMNS]
 
 
 # --------- KPI FEATS + RECS ---------
 
-def compute_kpis(weekly: pd.DataFrame, terms_df: pd.DataFrame) -> pd.DataFrame:
-    df = weekly.merge(terms_df[["market","language","term","intent"]],
-                      on=["market","language","term"], how="left").copy()
-    df = df.sort_values(["market","term","week_start"])
+def _segment_means(codes: np.ndarray, seg: np.ndarray, values: np.ndarray,
+                   n: int, n_seg: int) -> np.ndarray:
+    # Yksi bincount kaikille (ryhmä, segmentti)-pareille; seg < 0 jää pois.
+    # NaN-arvot ohitetaan kuten groupby.mean; tyhjä pari → NaN
+    mask = (seg >= 0) & ~np.isnan(values)
+    idx = codes[mask] * n_seg + seg[mask]
+    total = np.bincount(idx, weights=values[mask], minlength=n * n_seg)
+    count = np.bincount(idx, minlength=n * n_seg)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (total / count).reshape(n, n_seg)
+
+
+def compute_kpis(weekly: pd.DataFrame) -> pd.DataFrame:
+    # weekly sisältää jo intentin fetch_trendsistä → ei toista mergeä
+    # Ei esilajittelua: faktorointi ei tarvitse järjestystä, ja lopputulos lajitellaan kerran
+    df = weekly
     latest_week = df["week_start"].max()
 
-    last4_mask = df["week_start"] > (latest_week - pd.Timedelta(days=28))
-    prev4_mask = (df["week_start"] <= (latest_week - pd.Timedelta(days=28))) & \
-                 (df["week_start"] >  (latest_week - pd.Timedelta(days=56)))
+    # Yksi faktorointi avaimelle; keskiarvot bincountilla ilman groupby/merge-kierroksia
+    keys = ["market","language","term"]
+    codes, uniques = pd.MultiIndex.from_frame(df[keys]).factorize()
+    n = len(uniques)
+    values = df["trend_index_0_100"].to_numpy(dtype=float)
+    # Vertailut suoraan int64-ns:llä; rajat lasketaan kerran
+    ws = df["week_start"].to_numpy(dtype="datetime64[ns]").view("int64")
+    latest_ns = ws.max() if ws.size else 0
+    cut28 = latest_ns - 28 * DAY_NS
+    cut56 = latest_ns - 56 * DAY_NS
 
-    latest = df[df["week_start"] == latest_week].rename(columns={"trend_index_0_100":"latest"})[
-        ["market","language","term","latest","intent"]
-    ]
-    last4 = (df[last4_mask].groupby(["market","language","term"], as_index=False)
-             .agg(last4=("trend_index_0_100","mean")))
-    prev4 = (df[prev4_mask].groupby(["market","language","term"], as_index=False)
-             .agg(prev4=("trend_index_0_100","mean")))
+    # Segmentti: 0 = last4, 1 = prev4, -1 = vanhempi
+    seg = np.where(ws > cut28, 0, np.where(ws > cut56, 1, -1))
+    latest_mask = ws == latest_ns
 
-    out = latest.merge(last4, on=["market","language","term"], how="left") \
-                .merge(prev4, on=["market","language","term"], how="left")
+    at_latest = codes[latest_mask]
+    has_latest = np.zeros(n, dtype=bool)
+    has_latest[at_latest] = True
+    latest = np.full(n, np.nan)
+    latest[at_latest] = values[latest_mask]
+    intent = np.full(n, None, dtype=object)
+    intent[at_latest] = df["intent"].to_numpy()[latest_mask]
+
+    out = uniques.to_frame(index=False, name=keys)
+    out["latest"] = latest
+    out["intent"] = intent
+    means = _segment_means(codes, seg, values, n, 2)
+    out["last4"] = means[:, 0]
+    out["prev4"] = means[:, 1]
+    out = out[has_latest].reset_index(drop=True)
     out["growth_vs_prev4"] = (out["last4"] - out["prev4"]).fillna(0)
     out["score"] = out["latest"].fillna(0)*0.7 + out["growth_vs_prev4"]*0.3
     out["week"] = latest_week
-    return out.sort_values(["market","score"], ascending=[True,False])
-
-
-def _channel_rules(row):
-    term = (row["term"] or "").lower()
-    intent = (row.get("intent") or "").lower()
-    market = row["market"]
-    funnel = "Mid → Lower"
-    channels = ["Google Search (Exact/PH)", "Meta (Prospecting/RT)"]
-    audience = "Travel intenders; site visitors; lookalikes"
-    budget = "60% Search, 30% Meta, 10% Test"
-    if any(x in term for x in ["flight","lento","flüge","flyg"]) or intent == "flights":
-        funnel = "Lower + Mid"
-        channels = ["Google Search (Exact/BMM)", "Meta Video", "Performance Max (test)"]
-        audience = "O&D lookups (LON/STO/MUC), remarketing"
-        budget = "70% Search, 20% Meta, 10% PMax"
-    if intent in ("accommodation","brand"):
-        channels = ["Google Search (Brand/Generic)", "Meta RT", "YouTube Shorts (test)"]
-        funnel = "Lower (brand/generic) + Mid"
-        audience = "Brand engagers; room viewers; LAL"
-        budget = "65% Search, 25% Meta, 10% YouTube"
-    if intent in ("family","seasonal","activity"):
-        channels = ["Meta Reels/Stories", "TikTok Spark", "Google Discovery"]
-        funnel = "Upper → Mid"
-        audience = "Families; winter sports; aurora"
-        budget = "20% Search, 60% Social, 20% Discovery"
-    if market in ("GB","DE"):
-        channels = list(dict.fromkeys(channels + ["Pinterest (test)"]))
-    return funnel, ", ".join(channels), audience, budget
+    return out.sort_values(["market","score","term"], ascending=[True,False,True], kind="stable")
+
+
+# funnel, suggested_channels, audience_hint, budget_split
+_DEFAULT_RULE = ("Mid → Lower",
+                 "Google Search (Exact/PH), Meta (Prospecting/RT)",
+                 "Travel intenders; site visitors; lookalikes",
+                 "60% Search, 30% Meta, 10% Test")
+_FLIGHT_RULE = ("Lower + Mid",
+                "Google Search (Exact/BMM), Meta Video, Performance Max (test)",
+                "O&D lookups (LON/STO/MUC), remarketing",
+                "70% Search, 20% Meta, 10% PMax")
+_ACCOMMODATION_RULE = ("Lower (brand/generic) + Mid",
+                       "Google Search (Brand/Generic), Meta RT, YouTube Shorts (test)",
+                       "Brand engagers; room viewers; LAL",
+                       "65% Search, 25% Meta, 10% YouTube")
+_FAMILY_RULE = ("Upper → Mid",
+                "Meta Reels/Stories, TikTok Spark, Google Discovery",
+                "Families; winter sports; aurora",
+                "20% Search, 60% Social, 20% Discovery")
+RULE_COLUMNS = ["funnel","suggested_channels","audience_hint","budget_split"]
+_FLIGHT_RE = re.compile(r"flight|lento|flüge|flyg", re.IGNORECASE)
+
+
+def _channel_rules(recs: pd.DataFrame) -> pd.DataFrame:
+    term = recs["term"].astype(object).fillna("")
+    intent = recs["intent"].astype(object).fillna("").str.lower()
+    # Ensimmäinen osuma voittaa: family > accommodation/brand > flights > oletus
+    conds = [intent.isin(["family","seasonal","activity"]).to_numpy(),
+             intent.isin(["accommodation","brand"]).to_numpy(),
+             (term.str.contains(_FLIGHT_RE) | (intent == "flights")).to_numpy()]
+    rules = [_FAMILY_RULE, _ACCOMMODATION_RULE, _FLIGHT_RULE]
+    out = pd.DataFrame({
+        col: np.select(conds, [r[i] for r in rules], default=_DEFAULT_RULE[i])
+        for i, col in enumerate(RULE_COLUMNS)
+    }, index=recs.index)
+    out["suggested_channels"] = np.where(recs["market"].isin(["GB","DE"]),
+                                         out["suggested_channels"] + ", Pinterest (test)",
+                                         out["suggested_channels"])
+    return out
 
 
 def build_recommendations(kpis: pd.DataFrame, top_n_per_market: int = 5) -> pd.DataFrame:
-    recs = (kpis.sort_values(["market","score"], ascending=[True,False])
-                 .groupby("market").head(top_n_per_market).reset_index(drop=True))
+    # Vakaa lajittelu: compute_kpis:n (market, score desc, term) -järjestys säilyy tasapisteissä
+    recs = (kpis.sort_values(["market","score"], ascending=[True,False], kind="stable")
+                .groupby("market", sort=False, observed=True).head(top_n_per_market)
+                .reset_index(drop=True))
+    recs = recs.join(_channel_rules(recs))
+    cols = ["week","market","language","term","intent","latest","last4","prev4",
+            "growth_vs_prev4","score"] + RULE_COLUMNS
     rows = []
-    for _, r in recs.iterrows():
-        funnel, channels, audience, budget = _channel_rules(r)
-        why = f"latest={round(r['latest'],1)}, last4={round(r['last4'],1)}, prev4={round(r['prev4'],1)}, Δ4w={round(r['growth_vs_prev4'],1)}, score={round(r['score'],1)}"
+    for (week, market, language, term, intent, latest, last4, prev4, growth, score,
+         funnel, channels, audience, budget) in recs[cols].itertuples(index=False, name=None):
+        latest, last4, prev4 = round(latest,1), round(last4,1), round(prev4,1)
+        growth, score = round(growth,1), round(score,1)
+        why = f"latest={latest}, last4={last4}, prev4={prev4}, Δ4w={growth}, score={score}"
         rows.append({
-            "week": r["week"].date(),
-            "market": r["market"],
-            "language": r["language"],
-            "term": r["term"],
-            "intent": r.get("intent",""),
-            "latest": round(r["latest"],1),
-            "last4": round(r["last4"],1) if pd.notna(r["last4"]) else None,
-            "prev4": round(r["prev4"],1) if pd.notna(r["prev4"]) else None,
-            "growth_vs_prev4": round(r["growth_vs_prev4"],1),
-            "score": round(r["score"],1),
+            "week": week.date(),
+            "market": market,
+            "language": language,
+            "term": term,
+            "intent": intent,
+            "latest": latest,
+            "last4": None if math.isnan(last4) else last4,
+            "prev4": None if math.isnan(prev4) else prev4,
+            "growth_vs_prev4": growth,
+            "score": score,
             "funnel": funnel,
             "suggested_channels": channels,
             "audience_hint": audience,
@@ -174,25 +435,35 @@ def main():
     p = argparse.ArgumentParser(description="Ruka Trends → KPIs + Recs")
     p.add_argument("--terms", type=str, default="keywords_ruka.json")
     p.add_argument("--tz", type=int, default=180)
-    p.add_argument("--out", type=str, default="weekly_trends_output.csv")
+    p.add_argument("--out", type=str, default="weekly_trends_output.csv",
+                   help="Output file; .csv.gz writes gzipped CSV, .parquet writes zstd parquet")
+    p.add_argument("--cache-ttl", type=float, default=86400,
+                   help="Seconds a cached Trends response stays valid (0 disables the cache)")
+    p.add_argument("--force", action="store_true",
+                   help="Ignore cached Trends responses and refetch (the cache is still refreshed)")
+    p.add_argument("--sheet-id", type=str, default=os.environ.get("SHEET_ID"),
+                   help="Target spreadsheet key (default: $SHEET_ID)")
     args = p.parse_args()
 
     terms_df = load_terms(Path(args.terms))
-    weekly = fetch_trends(terms_df, tz=args.tz)
-    weekly.to_csv(args.out, index=False)
+    weekly = fetch_trends(terms_df, tz=args.tz, cache_ttl=args.cache_ttl, force=args.force)
+    write_frame(weekly, args.out)
     print(f"Saved: {args.out} (rows={len(weekly)})")
 
     # Raakadata
-    _maybe_sheet_update(weekly, "weekly_trends")
+    _maybe_sheet_update(weekly, "weekly_trends", args.sheet_id)
+    if weekly.empty:
+        print("[INFO] No data fetched; skipping KPIs/recs.")
+        return
 
     # KPI:t
-    kpis = compute_kpis(weekly, terms_df)
-    _maybe_sheet_update(kpis, "metrics_weekly")
+    kpis = compute_kpis(weekly)
+    _maybe_sheet_update(kpis, "metrics_weekly", args.sheet_id)
 
     # Suositukset
     recs = build_recommendations(kpis, top_n_per_market=5)
     if not recs.empty:
-        _maybe_sheet_update(recs, "recommendations")
+        _maybe_sheet_update(recs, "recommendations", args.sheet_id)
 
 
 if __name__ == "__main__":
@@ -1,21 +1,46 @@
 # update_sheet.py
 import os, json, gspread
+from datetime import date
+import pandas as pd
 from google.oauth2.service_account import Credentials
 
-def df_to_sheet(df, sheet_name: str, worksheet: str):
+SHEETS_CHUNK_ROWS = 5000
+_spreadsheets = {}  # yksi autentikointi + HTTP-sessio per ajo, jaettu välilehtien kesken
+
+def _open_spreadsheet(sheet_name: str, sheet_id: str = None):
+    sheet_id = sheet_id or os.environ.get("SHEET_ID")  # optional but recommended
+    key = sheet_id or sheet_name
+    if key in _spreadsheets:
+        return _spreadsheets[key]
+
     creds_json = os.environ["GOOGLE_SA_JSON"]  # repository secret
     creds_dict = json.loads(creds_json)
     scopes = ["https://www.googleapis.com/auth/spreadsheets"]
     creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
     gc = gspread.authorize(creds)
 
-    sheet_id = os.environ.get("SHEET_ID")  # optional but recommended
     if sheet_id:
         sh = gc.open_by_key(sheet_id)
         print(f"Using SHEET_ID: {sheet_id}")
     else:
         sh = gc.open(sheet_name)  # falls back to name (less reliable)
         print(f"Using SHEET_NAME: {sheet_name}")
+    _spreadsheets[key] = sh
+    return sh
+
+def _sheet_rows(df):
+    # Yksi object-taulukko ilman astype(str)-kopiota; NA → "", päivämäärät ISO-muotoon
+    arr = df.to_numpy(dtype=object, na_value="")
+    for i, col in enumerate(df.columns):
+        s = df.iloc[:, i]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            arr[:, i] = s.dt.strftime("%Y-%m-%d").fillna("").to_numpy(dtype=object)
+        elif s.dtype == object:
+            arr[:, i] = [v.isoformat() if isinstance(v, date) else v for v in arr[:, i]]
+    return [df.columns.tolist()] + arr.tolist()
+
+def df_to_sheet(df, sheet_name: str, worksheet: str, sheet_id: str = None):
+    sh = _open_spreadsheet(sheet_name, sheet_id)
 
     try:
         ws = sh.worksheet(worksheet)
@@ -23,5 +48,15 @@ def df_to_sheet(df, sheet_name: str, worksheet: str):
     except gspread.WorksheetNotFound:
         ws = sh.add_worksheet(title=worksheet, rows="2000", cols="30")
 
-    ws.update([df.columns.tolist()] + df.astype(str).values.tolist())
+    values = _sheet_rows(df)
+    if len(values) > ws.row_count or len(df.columns) > ws.col_count:
+        ws.resize(rows=max(len(values), ws.row_count), cols=max(len(df.columns), ws.col_count))
+    if os.environ.get("SHEETS_BATCH") == "1":
+        # RAW-kirjoitus enintään SHEETS_CHUNK_ROWS rivin paloina → ennustettava pyyntökoko
+        for start in range(0, len(values), SHEETS_CHUNK_ROWS):
+            ws.batch_update([{"range": f"A{start + 1}",
+                              "values": values[start:start + SHEETS_CHUNK_ROWS]}],
+                            value_input_option="RAW")
+    else:
+        ws.update(values)
     print(f"Updated worksheet: {worksheet} (rows={len(df)})")